@@ -1,14 +1,19 @@
+from dataclasses import dataclass
 import json
+import math
+import os
 from pathlib import Path
 import sys
-import time
+import threading
 
 try:
     from PyQt6.QtCore import (
         QObject,
+        QRunnable,
         QSize,
-        QThread,
         Qt,
+        QThreadPool,
+        QTimer,
         pyqtSignal,
         pyqtSlot
     )
@@ -17,8 +22,8 @@ try:
         QApplication,
         QComboBox,
         QDialog,
+        QFormLayout,
         QGridLayout,
-        QHBoxLayout,
         QLabel,
         QLCDNumber,
         QLineEdit,
@@ -34,9 +39,14 @@ except ImportError:
 import pyvisa
 from pymeasure.instruments.srs.sr830 import SR830
 
-import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 CONFIG_FILE = "config.json"
+# Keys of the polynomial coefficients in the configuration file
+_A_KEYS = ("a0", "a1", "a2", "a3", "a4", "a5")
 CONFIG_DEFAULT = {
     "bias_resistance": 1e6,
     "lockin_voltage": 4e-3,
@@ -48,39 +58,211 @@ CONFIG_DEFAULT = {
     "a4": 0,
     "a5": 0,
 }
+POLLING_INTERVAL = 3000  # ms
+
+def read_config(path: str) -> dict:
+    raw = Path(path).read_bytes()
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def write_config(path: str, config: dict) -> None:
+    raw = orjson.dumps(config) if orjson else json.dumps(config).encode()
+    # Write to a temporary file first so that the file is never left half written
+    tmp_file = path + ".tmp"
+    Path(tmp_file).write_bytes(raw)
+    os.replace(tmp_file, path)
+
+def lcd_text(value: float, digits: int) -> str:
+    """
+    Text shown by `QLCDNumber.display` for a float, following Qt: the
+    precision is lowered until the string fits in `digits` characters.
+    """
+    nd = digits
+    while True:
+        text = "%*.*g" % (digits, nd, value)
+        if nd == 0 or len(text) <= digits:
+            return text
+        nd -= 1
+
+@dataclass(frozen=True, slots=True)
+class ThermometryConfig:
+    """
+    Typed view of the configuration file, with the polynomial coefficients
+    a0 to a5 gathered in `a`.
+    """
+    bias_resistance: float
+    lockin_voltage: float
+    R0: float
+    a: tuple[float, ...]
+
+    @classmethod
+    def from_dict(cls, config: dict) -> "ThermometryConfig":
+        return cls(
+            bias_resistance=float(config["bias_resistance"]),
+            lockin_voltage=float(config["lockin_voltage"]),
+            R0=float(config["R0"]),
+            a=tuple(float(config[k]) for k in _A_KEYS)
+        )
+
+    def to_dict(self) -> dict:
+        config = {
+            "bias_resistance": self.bias_resistance,
+            "lockin_voltage": self.lockin_voltage,
+            "R0": self.R0
+        }
+        for k, c in zip(_A_KEYS, self.a):
+            config[k] = c
+        return config
+
+class LockinSignals(QObject):
+    value_ready = pyqtSignal(float)
+    failed = pyqtSignal(str)
+
+class WorkerLockinRead(QRunnable):
+    """
+    Read a lockin property (X by default) in the thread pool, a GPIB query
+    can take long enough to make the UI stutter. `lock` serializes the
+    queries on the VISA session, which is not thread-safe.
+    """
+
+    def __init__(self, lockin: SR830, lock: threading.Lock, quantity: str = "x") -> None:
+        super().__init__()
+        self.lockin = lockin
+        self.lock = lock
+        self.quantity = quantity
+        self.signals = LockinSignals()
+
+    @pyqtSlot()
+    def run(self):
+        # Only X is queried on each sample (the sine voltage is read once per
+        # configuration). SNAP? needs at least two outputs, so use
+        # `self.lockin.snap(...)` once more outputs are needed here.
+        try:
+            with self.lock:
+                v = getattr(self.lockin, self.quantity)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.value_ready.emit(v)
 
 class WorkerTempReading(QObject):
     update = pyqtSignal(float)
-
-    def get_T(self) -> float:
-        v = self.lockin.x
-        i = self.lockin.sine_voltage/self.config["bias_resistance"]
-        r = v/i
-        l_r = np.log(r - self.config["R0"])
-        sum = 0
-        for i in range(6):
-            sum += self.config[f"a{i}"]*l_r**i
-        return 1/np.exp(sum)
-
-    def __init__(self, lockin: SR830, config: dict) -> None:
+    error = pyqtSignal(str)
+
+    def to_T(self, v: float) -> float:
+        r = v*self._inv_i
+        # Keep the numpy semantics (nan/inf) outside of the fit domain, an
+        # exception raised here would abort the application from a Qt slot
+        if r <= self.config.R0:
+            return math.nan
+        l_r = math.log(r - self.config.R0)
+        # Horner's scheme
+        a0, a1, a2, a3, a4, a5 = self.config.a
+        s = ((((a5*l_r + a4)*l_r + a3)*l_r + a2)*l_r + a1)*l_r + a0
+        try:
+            return math.exp(-s)
+        except OverflowError:
+            return math.inf
+
+    def __init__(self, lockin: SR830, config: dict, interval: int = POLLING_INTERVAL) -> None:
         super().__init__()
         self.lockin = lockin
-        self.config = config
-    
+        # Held around every query, reads happen in the thread pool
+        self.lock = threading.Lock()
+        self._sine_voltage: float | None = None
+        self._inv_i: float | None = None
+        self.update_config(config)
+
+        # Polling runs on the main event loop, no dedicated thread needed
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.tick)
+        self.reading = False
+
+    @pyqtSlot()
+    def tick(self):
+        # Skip this sample if the previous read is still pending
+        if self.reading:
+            return
+        self.reading = True
+        worker = WorkerLockinRead(self.lockin, self.lock)
+        worker.signals.value_ready.connect(self.value_slot)
+        worker.signals.failed.connect(self.failed_slot)
+        QThreadPool.globalInstance().start(worker)
+
+    @pyqtSlot(float)
+    def value_slot(self, v: float):
+        self.reading = False
+        # Samples are dropped until the sine voltage has been read once
+        if self.timer.isActive() and self._inv_i is not None:
+            self.update.emit(self.to_T(v))
+
+    @pyqtSlot(str)
+    def failed_slot(self, message: str):
+        self.reading = False
+        self.error.emit(message)
+
     @pyqtSlot()
     def run(self):
-        self.running = True
-        while self.running:
-            self.update.emit(self.get_T())
-            time.sleep(3)
+        self.tick()
+        self.timer.start()
 
     @pyqtSlot()
     def stop(self):
-        self.running = False
+        self.timer.stop()
 
-    @pyqtSlot()
+    @pyqtSlot(int)
+    def set_interval(self, interval: int):
+        self.timer.setInterval(interval)
+
+    @pyqtSlot(dict)
     def update_config(self, config: dict):
-        self.config = config
+        self.config = ThermometryConfig.from_dict(config)
+        if self._sine_voltage:
+            self._inv_i = self.config.bias_resistance/self._sine_voltage
+
+        # The lockin output voltage only changes with the configuration, read it
+        # once here instead of on every sample
+        worker = WorkerLockinRead(self.lockin, self.lock, "sine_voltage")
+        worker.signals.value_ready.connect(self.sine_voltage_slot)
+        worker.signals.failed.connect(self.sine_voltage_failed_slot)
+        QThreadPool.globalInstance().start(worker)
+
+    @pyqtSlot(float)
+    def sine_voltage_slot(self, v: float):
+        if not v:
+            self.error.emit("Lockin sine voltage is zero, keeping the previous value.")
+            return
+        self._sine_voltage = v
+        self._inv_i = self.config.bias_resistance/v
+
+    @pyqtSlot(str)
+    def sine_voltage_failed_slot(self, message: str):
+        # Keep the previous value, if any
+        self.error.emit(f"Could not read the lockin sine voltage: {message}")
+
+class ResourcesSignals(QObject):
+    resources_ready = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+class WorkerListResources(QRunnable):
+    """
+    List the VISA resources in the thread pool, enumeration can take
+    several seconds and would otherwise freeze the UI.
+    """
+
+    def __init__(self, rm: pyvisa.ResourceManager) -> None:
+        super().__init__()
+        self.rm = rm
+        self.signals = ResourcesSignals()
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            resources = list(self.rm.list_resources())
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.resources_ready.emit(resources)
 
 class MainWindow(QMainWindow):
 
@@ -94,13 +276,10 @@ class MainWindow(QMainWindow):
 
         # Check if config file exist and load
         if not Path(CONFIG_FILE).is_file():
-            with open(CONFIG_FILE, 'w') as f:
-                json.dump(CONFIG_DEFAULT, f)
-        with open(CONFIG_FILE, 'r') as f:
-            self.config = json.load(f)
+            write_config(CONFIG_FILE, CONFIG_DEFAULT)
+        self.config = read_config(CONFIG_FILE)
 
-        # Threads
-        self.thread_temp = QThread()
+        # Workers
         self.worker_temp: WorkerTempReading | None = None
 
         self.setWindowTitle("Lockin temperature measurement UI")
@@ -115,6 +294,8 @@ class MainWindow(QMainWindow):
         self.edit = QPushButton("Edit")
         self.temp = QLCDNumber()
         self.temp_l = QLabel("K")
+        self._last_lcd: str | None = None
+        self._last_unit = "K"
         self.gpib = QComboBox()
         self.gpib_l = QLabel("GPIB address:")
         self.gpib_refresh = QPushButton("Refresh")
@@ -131,7 +312,7 @@ class MainWindow(QMainWindow):
         layout_b.addWidget(self.edit)
 
         # Populate widgets
-        self.gpib.addItems(self.rm.list_resources())
+        self.refresh_gpib_list()
         self.gpib.addItems(["Test 1", "Test 2"])  # To remove
 
         # Signal
@@ -146,9 +327,26 @@ class MainWindow(QMainWindow):
     def refresh_gpib_list(self) -> None:
         self.status_bar.showMessage("Looking for GPIB devices...")
         QApplication.setOverrideCursor(QCursor(Qt.CursorShape.WaitCursor))
+        self.gpib_refresh.setEnabled(False)
         self.gpib.clear()
-        self.gpib.addItems(self.rm.list_resources())
-        self.status_bar.showMessage(f"Found {self.gpib.count()} GPIB devices.", 5000)
+        worker = WorkerListResources(self.rm)
+        worker.signals.resources_ready.connect(self.gpib_list_slot)
+        worker.signals.failed.connect(self.gpib_list_failed_slot)
+        QThreadPool.globalInstance().start(worker)
+
+    @pyqtSlot(list)
+    def gpib_list_slot(self, resources: list):
+        self.gpib.insertItems(0, resources)
+        self.status_bar.showMessage(f"Found {len(resources)} GPIB devices.", 5000)
+        self.gpib_list_done()
+
+    @pyqtSlot(str)
+    def gpib_list_failed_slot(self, message: str):
+        self.status_bar.showMessage(f"Could not list GPIB devices: {message}", 5000)
+        self.gpib_list_done()
+
+    def gpib_list_done(self) -> None:
+        self.gpib_refresh.setEnabled(True)
         QApplication.restoreOverrideCursor()
 
     def connect_slot(self)-> None:
@@ -159,37 +357,36 @@ class MainWindow(QMainWindow):
             except Exception as e:
                 self.status_bar.showMessage(f"Disconnected.")
                 self.lockin = None
-                m = QMessageBox(self)
-                m.setWindowTitle("Error")
-                m.setText(f"Could not connect to {self.gpib.currentText()}.\n{e}")
-                m.setStandardButtons(QMessageBox.StandardButton.Yes)
-                m.setIcon(QMessageBox.Icon.Critical)
-                m.show()
+                QMessageBox.critical(self, "Error", f"Could not connect to {self.gpib.currentText()}.\n{e}")
                 return
             
             self.status_bar.showMessage(f"Connected to {self.gpib.currentText()}.")
             self.connect.setText("Disconnect")
             self.status = 1
 
-            # Start thread
+            # Start polling
             self.worker_temp = WorkerTempReading(self.lockin, self.config)
-            self.worker_temp.moveToThread(self.thread_temp)
-            self.thread_temp.started.connect(self.worker_temp.run)
             self.worker_temp.update.connect(self.update_LCD)
-            self.thread_temp.start()
+            self.worker_temp.error.connect(self.status_bar.showMessage)
+            if self.edit_window:
+                self.edit_window.send_config.connect(self.worker_temp.update_config)
+            self.worker_temp.run()
         elif self.status == 1:
             if self.worker_temp:
                 self.worker_temp.stop()
+                if self.edit_window:
+                    self.edit_window.send_config.disconnect(self.worker_temp.update_config)
+                self.worker_temp = None
             self.status_bar.showMessage(f"Disconnected.")
             self.connect.setText("Connect")
             self.status = 0
 
     def edit_slot(self):
         if self.edit_window == None:
-            self.edit_window = EditWindow()
-        self.edit_window.send_config.connect(self.update_config)
-        if self.worker_temp:
-            self.edit_window.send_config.connect(self.worker_temp.update_config)
+            self.edit_window = EditWindow(self.config)
+            self.edit_window.send_config.connect(self.update_config)
+            if self.worker_temp:
+                self.edit_window.send_config.connect(self.worker_temp.update_config)
         self.edit_window.show()
 
     @pyqtSlot(dict)
@@ -200,106 +397,79 @@ class MainWindow(QMainWindow):
     def update_LCD(self, value: float):
         if value >= 1:
             # Kelvin range
-            self.temp.display(value)
-            self.temp_l.setText("K")
+            shown = value
+            unit = "K"
         else:
             # mK range
-            self.temp.display(value*1e3)
-            self.temp_l.setText("mK")
+            shown = value*1e3
+            unit = "mK"
+
+        # Skip the Qt calls when the displayed text would not change
+        text = lcd_text(shown, self.temp.digitCount())
+        if text != self._last_lcd:
+            self.temp.display(shown)
+            self._last_lcd = text
+        if unit != self._last_unit:
+            self.temp_l.setText(unit)
+            self._last_unit = unit
 
 
 class EditWindow(QDialog):
     send_config = pyqtSignal(dict)
 
-    def __init__(self) -> None:
+    def __init__(self, config: dict) -> None:
         super().__init__()
         self.setWindowTitle("Parameters")
         self.resize(600, 400)
 
-        layout = QVBoxLayout()
-        layout_resistance= QHBoxLayout()
-        layout_voltage= QHBoxLayout()
-        layout_r0 = QHBoxLayout()
+        layout = QFormLayout()
+        validator = QDoubleValidator(self)
 
         self.resistance = QLineEdit()
-        self.resistance.setValidator(QDoubleValidator())
-        self.resistance_l = QLabel("Bias resistance (Ohm)")
-        self.resistance_w = QWidget()
+        self.resistance.setValidator(validator)
         self.voltage = QLineEdit()
-        self.voltage.setValidator(QDoubleValidator())
-        self.voltage_l = QLabel("Lockin output voltage (V)")
-        self.voltage_w = QWidget()
+        self.voltage.setValidator(validator)
         self.r0 = QLineEdit()
-        self.r0.setValidator(QDoubleValidator())
-        self.r0_l = QLabel("R0 (Ohm)")
-        self.r0_w = QWidget()
+        self.r0.setValidator(validator)
         self.exp = QLabel("log(1/T)=sum(i=0->5)[a_i*log(r_i - r0)^i]")
         self.coeff: list[QLineEdit] = []
-        self.coeff_l: list[QLabel] = []
-        for i in range(6):
+        for _ in _A_KEYS:
             le = QLineEdit()
-            le.setValidator(QDoubleValidator())
+            le.setValidator(validator)
             self.coeff.append(le)
-            self.coeff_l.append(QLabel(f"A{i}"))
         self.save = QPushButton("Save")
 
-        self.resistance_w.setLayout(layout_resistance)
-        layout_resistance.addWidget(self.resistance_l)
-        layout_resistance.addWidget(self.resistance)
-
-        self.voltage_w.setLayout(layout_voltage)
-        layout_voltage.addWidget(self.voltage_l)
-        layout_voltage.addWidget(self.voltage)
-
-        self.r0_w.setLayout(layout_r0)
-        layout_r0.addWidget(self.r0_l)
-        layout_r0.addWidget(self.r0)
-
-        layout.addWidget(self.resistance_w)
-        layout.addWidget(self.voltage_w)
-        layout.addWidget(self.r0_w)
-        layout.addWidget(self.exp)
+        layout.addRow("Bias resistance (Ohm)", self.resistance)
+        layout.addRow("Lockin output voltage (V)", self.voltage)
+        layout.addRow("R0 (Ohm)", self.r0)
+        layout.addRow(self.exp)
+        for k, le in zip(_A_KEYS, self.coeff):
+            layout.addRow(k.upper(), le)
+        layout.addRow(self.save)
 
-        for i in range(6):
-            widget = QWidget()
-            layout_coeff = QHBoxLayout()
-            layout_coeff.addWidget(self.coeff_l[i])
-            layout_coeff.addWidget(self.coeff[i])
-            widget.setLayout(layout_coeff)
-            layout.addWidget(widget)
-
-        layout.addWidget(self.save)
-        
         self.setLayout(layout)
 
         # Load parameters
-        with open(CONFIG_FILE, "r") as f:
-            self.config = json.load(f)
-        self.resistance.setText(str(self.config["bias_resistance"]))
-        self.r0.setText(str(self.config["R0"]))
-        self.voltage.setText(str(self.config["lockin_voltage"]))
-        for i in range(6):
-            self.coeff[i].setText(str(self.config[f"a{i}"]))
+        self.config = ThermometryConfig.from_dict(config)
+        self.resistance.setText(str(self.config.bias_resistance))
+        self.r0.setText(str(self.config.R0))
+        self.voltage.setText(str(self.config.lockin_voltage))
+        for le, c in zip(self.coeff, self.config.a):
+            le.setText(str(c))
 
         # Connect slots
         self.save.clicked.connect(self.save_slot)
 
     def save_slot(self):
-        config = {
-            "bias_resistance": float(self.resistance.text()),
-            "lockin_voltage": float(self.voltage.text()),
-            "a0": float(self.coeff[0].text()),
-            "a1": float(self.coeff[1].text()),
-            "a2": float(self.coeff[2].text()),
-            "a3": float(self.coeff[3].text()),
-            "a4": float(self.coeff[4].text()),
-            "a5": float(self.coeff[5].text()),
-            "R0": float(self.r0.text())
-        }
+        config = ThermometryConfig(
+            bias_resistance=float(self.resistance.text()),
+            lockin_voltage=float(self.voltage.text()),
+            R0=float(self.r0.text()),
+            a=tuple(float(le.text()) for le in self.coeff)
+        ).to_dict()
 
         # Save and emit signal
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(config, f)
+        write_config(CONFIG_FILE, config)
         self.send_config.emit(config)
 
         self.close()
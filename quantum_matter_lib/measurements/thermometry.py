@@ -1,16 +1,84 @@
 """
 Module with a set of functions related to the thermometry inside our cryostat
 """
+import functools
 import json
+import os
+from pathlib import Path
 
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
 RESISTANCE_CALIBRATION_FILE = "config/thermometry/resistance_calibration.json"
 
-def temperature_ruo2(resistance: float, name: str) -> float:
+@functools.lru_cache(maxsize=4)
+def _load_calibration(path: str, mtime: int) -> dict | None:
+    """
+    Load the ruo2 calibration data. The modification time is only used as a
+    cache key so that the file is parsed again when it changes on disk.
+    Coefficients of valid calibrations are stored as float64 arrays.
+    """
+    raw = Path(path).read_bytes()
+    data = (orjson.loads(raw) if orjson else json.loads(raw))['ruo2']
+    if data is None:
+        return None
+    for r_data in data.values():
+        if ("R0" in r_data) and ("a" in r_data):
+            r_data["R0"] = float(r_data["R0"])
+            r_data["a"] = np.asarray(r_data["a"], dtype=np.float64)
+    return data
+
+def _ruo2_calibration(name: str) -> tuple[float, np.ndarray]:
+    """
+    Return `R0` and the polynomial coefficients of a ruo2 resistance.
+    """
+    mtime = os.stat(RESISTANCE_CALIBRATION_FILE).st_mtime_ns
+    data = _load_calibration(RESISTANCE_CALIBRATION_FILE, mtime)
+    if data is None:
+        raise Exception("Unable to parse data file.")
+    if not name in data:
+        raise Exception(f"Resistance {name} does not exist in configuration file.")
+    r_data = data[name]
+    if (not "R0" in r_data) or (not "a" in r_data):
+        raise Exception(f"The calibration for this resistance is not valid.")
+    return r_data["R0"], r_data["a"]
+
+if HAS_NUMBA:
+    # Fast math without the no-nan/no-inf assumptions, log and exp return
+    # nan/inf outside of the fit domain like the numpy fallback
+    _FASTMATH = {"reassoc", "contract", "arcp", "afn", "nsz"}
+
+    @njit(cache=True, fastmath=_FASTMATH)
+    def _ruo2_kernel(r, r0, a):
+        l_r = np.log(r - r0)
+        s = 0.0
+        for i in range(a.size - 1, -1, -1):
+            s = s*l_r + a[i]
+        return np.exp(-s)
+
+    @njit(cache=True, fastmath=_FASTMATH, parallel=True)
+    def _ruo2_kernel_array(r, r0, a):
+        t = np.empty_like(r)
+        for j in prange(r.size):
+            t[j] = _ruo2_kernel(r[j], r0, a)
+        return t
+
+def temperature_ruo2(resistance: float | np.ndarray, name: str) -> float | np.ndarray:
     """
     Conversion from resistance  to temperature using polynomial fit.
     It uses the data from `config/thermometry/resistance_calibration.json`.
+    An array of resistances is converted in a single vectorized evaluation.
+    When `numba` is installed, the evaluation is done by a compiled kernel.
 
     The calibration must be a child of `ruo2` and have the following format:
 
@@ -29,31 +97,66 @@ def temperature_ruo2(resistance: float, name: str) -> float:
     Source: https://www.epfl.ch/labs/lqm/wp-content/uploads/2018/07/TPIV_Pau_LQM.pdf
 
 
-    :param resistance: Value of the resistance in ohm
-    :type resistance: float
+    :param resistance: Value(s) of the resistance in ohm
+    :type resistance: float | np.ndarray
     :param name: Name of the resistance in calibration data
     :type name: str
     :raises Exception: Unable to parse calibration data file
     :raises Exception: Calibration for the given resistance name does not exist
     :raises Exception: Invalid calibration
-    :return: Temperature in kelvin
-    :rtype: float
+    :return: Temperature(s) in kelvin, with the same shape as `resistance`
+    :rtype: float | np.ndarray
     """    
 
-    # Load configuration
-    with open(RESISTANCE_CALIBRATION_FILE, "r") as f:
-        data = json.load(f)['ruo2']
-    if data is None:
-        raise Exception("Unable to parse data file.")
-    if not name in data:
-        raise Exception(f"Resistance {name} does not exist in configuration file.")
-    r_data = data[name]
-    if (not "R0" in r_data) or (not "a" in r_data):
-        raise Exception(f"The calibration for this resistance is not valid.")
+    # Load configuration (cached until the calibration file changes)
+    r0, a = _ruo2_calibration(name)
 
     # Compute resistance with polynomial fit
-    l_r = np.log(resistance - r_data["R0"])
-    sum = 0
-    for i in range(len(r_data["a"])):
-        sum +=  r_data["a"][i]*l_r**i
-    return float(1/np.exp(sum))
+    r = np.asarray(resistance, dtype=np.float64)
+    if HAS_NUMBA:
+        if r.ndim == 0:
+            return float(_ruo2_kernel(float(r), r0, a))
+        return _ruo2_kernel_array(r.ravel(), r0, a).reshape(r.shape)
+    l_r = np.log(r - r0)
+    s = np.polynomial.polynomial.polyval(l_r, a)
+    t = np.exp(-s)
+    if t.ndim == 0:
+        return float(t)
+    return t
+
+def temperature_ruo2_array(resistance: np.ndarray, name: str, out: np.ndarray | None = None) -> np.ndarray:
+    """
+    Conversion of an array of resistances to temperatures, see
+    :func:`temperature_ruo2` for the calibration format and the fit expression.
+
+    The computation is done in place in `out` to avoid allocating temporary
+    arrays on long acquisitions.
+
+    :param resistance: Values of the resistance in ohm
+    :type resistance: np.ndarray
+    :param name: Name of the resistance in calibration data
+    :type name: str
+    :param out: Preallocated float64 array with the shape of `resistance`, a new array is allocated if None
+    :type out: np.ndarray | None
+    :raises Exception: Unable to parse calibration data file
+    :raises Exception: Calibration for the given resistance name does not exist
+    :raises Exception: Invalid calibration
+    :return: Temperatures in kelvin, `out` if it was given
+    :rtype: np.ndarray
+    """
+
+    # Load configuration (cached until the calibration file changes)
+    r0, a = _ruo2_calibration(name)
+    if out is None:
+        out = np.empty(np.shape(resistance), dtype=np.float64)
+
+    # Compute resistance with polynomial fit, using Horner's scheme
+    np.subtract(resistance, r0, out=out)
+    np.log(out, out=out)
+    s = np.full_like(out, a[-1])
+    for c in a[-2::-1]:
+        s *= out
+        s += c
+    np.negative(s, out=s)
+    np.exp(s, out=out)
+    return out